@@ -0,0 +1,552 @@
+import sys
+import json
+import base64
+import hmac
+import queue
+import secrets
+import threading
+import time
+import http.client
+from urllib.parse import urlsplit
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# ----------------------------
+# Configuration
+# ----------------------------
+DEFAULT_PORT = 8765
+DEFAULT_UPSTREAM_URL = "https://graph.microsoft.com"
+LISTEN_HOST = "127.0.0.1"  # Never expose the proxy beyond this machine
+UPSTREAM_TIMEOUT_SECONDS = 60
+MAX_POOLED_CONNECTIONS = 8  # Idle keep-alive connections kept per upstream host
+REFRESH_COOLDOWN_SECONDS = 300  # Don't force another (interactive) login within this window
+SECRET_HEADER = "X-Proxy-Secret"  # Shared secret the VBA side must send on every request
+SECRET_REGISTRY_VALUE = "ProxySecret"
+OPAQUE_TOKEN_LIFETIME_SECONDS = 3600  # Assumed lifetime when a token has no readable 'exp' claim
+
+# Headers that apply to a single connection and must not be forwarded
+HOP_BY_HOP_HEADERS = {
+    "connection", "keep-alive", "proxy-authenticate", "proxy-authorization",
+    "te", "trailers", "transfer-encoding", "upgrade",
+}
+
+# Request headers the proxy replaces or consumes itself
+STRIPPED_REQUEST_HEADERS = {"host", "authorization", SECRET_HEADER.lower()}
+
+# Methods that are safe to resend if a pooled connection turns out to be stale
+# (all of them are handled by ProxyHandler)
+RETRYABLE_METHODS = {"GET", "HEAD", "OPTIONS"}
+
+# ----------------------------
+# Token Cache
+# ----------------------------
+
+# auth_get_token_v4 keeps the registry path in a module global, so token lookups
+# for different profiles must not interleave.
+_auth_lock = threading.Lock()
+
+def token_expiry(token: str):
+    """Return when the token expires, from its JWT 'exp' claim.
+
+    Opaque tokens (no readable 'exp') get a fixed lifetime instead of being treated
+    as already expired; a 401 from the upstream still triggers a refresh.
+    """
+    try:
+        payload_part = token.split('.')[1]
+        payload_encoded = payload_part + '=' * (-len(payload_part) % 4)
+        payload = json.loads(base64.urlsafe_b64decode(payload_encoded).decode('utf-8'))
+        exp = int(payload.get("exp", 0))
+    except Exception:
+        exp = 0
+    return exp or time.time() + OPAQUE_TOKEN_LIFETIME_SECONDS
+
+class TokenCache:
+    """In-memory token for one registry profile, refreshed via auth_get_token_v4 (`auth`)."""
+
+    def __init__(self, registry_path: str, auth):
+        self.registry_path = registry_path
+        self.auth = auth
+        self.token = None
+        self.expires_at = 0
+        self.refreshed_at = 0
+
+    def _is_fresh(self):
+        threshold = self.auth.EXPIRY_THRESHOLD_MINUTES * 60
+        return self.token and self.expires_at - time.time() > threshold
+
+    def get(self):
+        """Return the cached token, going through auth_get_token_v4 when it is near expiry."""
+        if self._is_fresh():
+            return self.token
+
+        with _auth_lock:
+            # Another request may have refreshed the token while we waited.
+            if self._is_fresh():
+                return self.token
+
+            self.auth.set_registry_path(self.registry_path)
+            token = self.auth.get_token()
+            if token:
+                self.token = token
+                self.expires_at = token_expiry(token)
+            return token
+
+    def refresh(self, rejected_token: str):
+        """Replace a token the upstream rejected. Returns None if no retry should be made."""
+        with _auth_lock:
+            # Concurrent 401s for the same token share a single refresh.
+            if self.token and self.token != rejected_token:
+                return self.token
+            # acquire_token() may open an interactive login, so don't loop on an upstream
+            # that rejects every token (e.g. wrong scope or audience).
+            if time.time() - self.refreshed_at < REFRESH_COOLDOWN_SECONDS:
+                return None
+
+            self.refreshed_at = time.time()
+            self.auth.set_registry_path(self.registry_path)
+            token = self.auth.acquire_token()
+            if token:
+                self.auth.store_token_in_registry(token)
+                self.token = token
+                self.expires_at = token_expiry(token)
+            return token
+
+# ----------------------------
+# Upstream Connection Pool
+# ----------------------------
+
+class ConnectionPool:
+    """Keep-alive connections to one upstream host, reused across requests."""
+
+    def __init__(self, base_url: str):
+        parts = urlsplit(base_url)
+        self.scheme = parts.scheme
+        self.host = parts.hostname
+        self.port = parts.port
+        self.base_path = parts.path.rstrip("/")
+        self.idle = queue.LifoQueue(maxsize=MAX_POOLED_CONNECTIONS)
+
+    def _new_connection(self):
+        if self.scheme == "https":
+            return http.client.HTTPSConnection(self.host, self.port, timeout=UPSTREAM_TIMEOUT_SECONDS)
+        return http.client.HTTPConnection(self.host, self.port, timeout=UPSTREAM_TIMEOUT_SECONDS)
+
+    def _release(self, conn):
+        try:
+            self.idle.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+    def _send(self, conn, method: str, path: str, body, headers: dict):
+        """Send one request on conn, closing it on any error."""
+        try:
+            conn.request(method, self.base_path + path, body=body, headers=headers)
+            response = conn.getresponse()
+            data = response.read()
+        except BaseException:
+            conn.close()
+            raise
+
+        if response.will_close:
+            conn.close()
+        else:
+            self._release(conn)
+        return response.status, response.reason, response.getheaders(), data
+
+    def request(self, method: str, path: str, body, headers: dict):
+        """Send a request and return (status, reason, headers, body)."""
+        try:
+            conn = self.idle.get_nowait()
+        except queue.Empty:
+            return self._send(self._new_connection(), method, path, body, headers)
+
+        try:
+            return self._send(conn, method, path, body, headers)
+        except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+            # The upstream closed an idle keep-alive connection. Only resend requests
+            # that are safe to repeat, since a POST may already have been processed.
+            if method not in RETRYABLE_METHODS:
+                raise
+            return self._send(self._new_connection(), method, path, body, headers)
+
+# ----------------------------
+# Routes
+# ----------------------------
+
+class Route:
+    """Maps a local path prefix to an upstream API using one registry profile."""
+
+    def __init__(self, prefix: str, registry_path: str, upstream_url: str, secret: str, auth):
+        self.prefix = "/" + prefix.strip("/")
+        self.tokens = TokenCache(registry_path, auth)
+        self.pool = ConnectionPool(upstream_url)
+        self.secret = secret
+
+def load_secret(auth, registry_path: str):
+    """Read the profile's proxy secret, generating and storing one on first use."""
+    import winreg
+
+    secret = auth.read_registry_value(SECRET_REGISTRY_VALUE)
+    if secret:
+        return secret
+    secret = secrets.token_urlsafe(32)
+    with winreg.CreateKey(winreg.HKEY_CURRENT_USER, registry_path) as reg_key:
+        winreg.SetValueEx(reg_key, SECRET_REGISTRY_VALUE, 0, winreg.REG_SZ, secret)
+    print(f"✅ Proxy secret saved to registry ({registry_path}\\{SECRET_REGISTRY_VALUE}).")
+    return secret
+
+def load_route(prefix: str, registry_path: str):
+    """Build a route, reading the upstream base URL and secret from the profile's registry key."""
+    # Imported here so the offline fake mode also runs where winreg/msal are unavailable.
+    import auth_get_token_v4 as auth
+
+    auth.set_registry_path(registry_path)
+    upstream_url = auth.read_registry_value("UpstreamUrl", DEFAULT_UPSTREAM_URL)
+    return Route(prefix, registry_path, upstream_url, load_secret(auth, registry_path), auth)
+
+def match_route(routes, path: str):
+    """Return (route, upstream_path) for the longest matching prefix."""
+    for route in sorted(routes, key=lambda r: len(r.prefix), reverse=True):
+        if path == route.prefix or path.startswith(route.prefix + "/") or path.startswith(route.prefix + "?"):
+            rest = path[len(route.prefix):]
+            if not rest.startswith("/"):
+                rest = "/" + rest
+            return route, rest
+    return None, None
+
+# ----------------------------
+# Proxy Server
+# ----------------------------
+
+def make_handler(routes):
+    class ProxyHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"  # Lets the VBA side keep its connection open too
+
+        def _is_local_request(self):
+            """Reject DNS-rebinding (foreign Host) and browser cross-site requests (any Origin)."""
+            port = self.server.server_address[1]
+            host = (self.headers.get("Host") or "").lower()
+            if host not in (f"127.0.0.1:{port}", f"localhost:{port}"):
+                return False
+            return "Origin" not in self.headers
+
+        def _proxy(self):
+            if "Transfer-Encoding" in self.headers:
+                # Chunked bodies aren't supported; close so unread chunks can't leak into the next request.
+                self.close_connection = True
+                self._send_error(411, "Send the request body with Content-Length")
+                return
+
+            length = int(self.headers.get("Content-Length", 0) or 0)
+            body = self.rfile.read(length) if length else None
+
+            if not self._is_local_request():
+                self._send_error(403, "Forbidden")
+                return
+
+            route, upstream_path = match_route(routes, self.path)
+            if not route:
+                self._send_error(404, f"No route for {self.path}")
+                return
+
+            if not hmac.compare_digest(self.headers.get(SECRET_HEADER, ""), route.secret):
+                self._send_error(403, f"Missing or invalid {SECRET_HEADER}")
+                return
+
+            headers = {
+                k: v for k, v in self.headers.items()
+                if k.lower() not in HOP_BY_HOP_HEADERS and k.lower() not in STRIPPED_REQUEST_HEADERS
+            }
+
+            token = route.tokens.get()
+            if not token:
+                self._send_error(502, "Token acquisition failed")
+                return
+
+            headers["Authorization"] = f"Bearer {token}"
+            status, reason, resp_headers, data = route.pool.request(self.command, upstream_path, body, headers)
+
+            if status == 401:
+                # Token was revoked or rejected early; refresh once (shared, rate-limited) and retry.
+                new_token = route.tokens.refresh(token)
+                if new_token and new_token != token:
+                    headers["Authorization"] = f"Bearer {new_token}"
+                    status, reason, resp_headers, data = route.pool.request(self.command, upstream_path, body, headers)
+
+            self.send_response(status, reason)
+            content_length = str(len(data))
+            for name, value in resp_headers:
+                if name.lower() == "content-length":
+                    if self.command == "HEAD":
+                        content_length = value  # HEAD reports the size of the body it doesn't send
+                elif name.lower() not in HOP_BY_HOP_HEADERS:
+                    self.send_header(name, value)
+            self.send_header("Content-Length", content_length)
+            self.end_headers()
+            if self.command != "HEAD":
+                self.wfile.write(data)
+
+        def _send_error(self, status: int, message: str):
+            payload = json.dumps({"error": message}).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            if self.command != "HEAD":
+                self.wfile.write(payload)
+
+        def _handle(self):
+            try:
+                self._proxy()
+            except Exception as e:
+                print(f"❌ Proxy error for {self.command} {self.path}: {e}")
+                self._send_error(502, str(e))
+
+        do_GET = do_HEAD = do_OPTIONS = do_POST = do_PUT = do_PATCH = do_DELETE = _handle
+
+    return ProxyHandler
+
+def serve(routes, port: int = DEFAULT_PORT):
+    httpd = ThreadingHTTPServer((LISTEN_HOST, port), make_handler(routes))
+    for route in routes:
+        print(f"➡️  http://{LISTEN_HOST}:{port}{route.prefix} -> "
+              f"{route.pool.scheme}://{route.pool.host}{route.pool.base_path} "
+              f"(registry: {route.tokens.registry_path})")
+    print("✅ Auth proxy running. Press Ctrl+C to stop.")
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        httpd.server_close()
+
+# ----------------------------
+# Fake Upstream (offline testing)
+# ----------------------------
+
+FAKE_SECRET = "fake-secret"
+
+def fake_token(serial: int, exp=None):
+    """Build an unsigned JWT-shaped token whose signature part is its serial number."""
+    claims = {"exp": exp if exp is not None else int(time.time()) + 3600}
+    payload = base64.urlsafe_b64encode(json.dumps(claims).encode("utf-8")).decode("ascii").rstrip("=")
+    return f"fake.{payload}.{serial}"
+
+class FakeAuth:
+    """Stand-in for auth_get_token_v4 that counts token lookups instead of touching the registry."""
+
+    EXPIRY_THRESHOLD_MINUTES = 15
+
+    def __init__(self, opaque: bool = False):
+        self.opaque = opaque
+        self.serial = 1
+        self.get_calls = 0
+        self.acquire_calls = 0
+
+    def set_registry_path(self, reg_path: str):
+        pass
+
+    def _token(self):
+        return f"opaque-{self.serial}" if self.opaque else fake_token(self.serial)
+
+    def get_token(self):
+        self.get_calls += 1
+        return self._token()
+
+    def acquire_token(self):
+        self.acquire_calls += 1
+        time.sleep(0.1)  # Give concurrent 401s time to pile up behind the lock
+        self.serial += 1
+        return self._token()
+
+    def store_token_in_registry(self, token: str):
+        pass
+
+class FakeUpstream:
+    """Local upstream API that records what the proxy forwarded.
+
+    /reject returns 401 for the first token, /always returns 401 for every token and
+    /drop closes the keep-alive connection without telling the client.
+    """
+
+    def __init__(self):
+        self.requests = []  # (method, path, headers, client port)
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), self._make_handler())
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.httpd.server_address[1]}/v1.0"
+
+    def start(self):
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def _make_handler(self):
+        upstream = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                pass
+
+            def _handle(self):
+                length = int(self.headers.get("Content-Length", 0) or 0)
+                if length:
+                    self.rfile.read(length)
+                upstream.requests.append((self.command, self.path, dict(self.headers), self.client_address[1]))
+
+                auth_header = self.headers.get("Authorization", "")
+                status = 200
+                if self.path.startswith("/v1.0/always") or (
+                    self.path.startswith("/v1.0/reject") and auth_header.endswith(".1")
+                ):
+                    status = 401
+
+                payload = json.dumps({"path": self.path}).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                if self.command != "HEAD":
+                    self.wfile.write(payload)
+                if self.path.startswith("/v1.0/drop"):
+                    self.close_connection = True
+
+            do_GET = do_HEAD = do_OPTIONS = do_POST = _handle
+
+        return Handler
+
+def check(condition: bool, message: str):
+    """Fail the offline checks with a readable message (unlike assert, not stripped by -O)."""
+    if not condition:
+        raise AssertionError(message)
+
+def run_fake_checks():
+    """Verify routing, local-only access, pooling, retries and token refresh against a fake upstream."""
+    upstream = FakeUpstream().start()
+    auth = FakeAuth()
+    route = Route("graph", "Fake", upstream.url, FAKE_SECRET, auth)
+    httpd = ThreadingHTTPServer((LISTEN_HOST, 0), make_handler([route]))
+    httpd.daemon_threads = True
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    port = httpd.server_address[1]
+
+    def call(path, headers=None, method="GET", body=None):
+        conn = http.client.HTTPConnection(LISTEN_HOST, port, timeout=10)
+        try:
+            sent = {SECRET_HEADER: FAKE_SECRET}
+            sent.update(headers or {})
+            conn.request(method, path, body=body, headers=sent)
+            response = conn.getresponse()
+            return response.status, response.read()
+        finally:
+            conn.close()
+
+    def last_forwarded():
+        return upstream.requests[-1]
+
+    try:
+        # Prefix and query mapping
+        check(call("/graph/me")[0] == 200, "routed request failed")
+        check(last_forwarded()[1] == "/v1.0/me", "prefix was not mapped to the upstream base path")
+        call("/graph?$top=1")
+        check(last_forwarded()[1] == "/v1.0/?$top=1", "query on the bare prefix was not mapped to a path")
+        check(call("/nope")[0] == 404, "unknown prefix was not rejected")
+
+        # Token and secret handling
+        call("/graph/me", {"Authorization": "Bearer caller-token"})
+        forwarded = {k.lower(): v for k, v in last_forwarded()[2].items()}
+        check(forwarded["authorization"].startswith("Bearer fake.") and forwarded["authorization"].endswith(".1"),
+              "cached token was not attached in place of the caller's header")
+        check(SECRET_HEADER.lower() not in forwarded, "proxy secret was forwarded upstream")
+        check(auth.get_calls == 1, "token was looked up more than once while still valid")
+
+        # Local-only access
+        forwarded_count = len(upstream.requests)
+        check(call("/graph/me", {"Host": f"evil.example.com:{port}"})[0] == 403, "foreign Host was not rejected")
+        check(call("/graph/me", {"Origin": "http://evil.example.com"}, "POST", b"x")[0] == 403,
+              "request with Origin was not rejected")
+        check(call("/graph/me", {SECRET_HEADER: "wrong"})[0] == 403, "wrong secret was not rejected")
+        check(call("/graph/me", {"Host": f"localhost:{port}"})[0] == 200, "localhost Host was rejected")
+        check(len(upstream.requests) == forwarded_count + 1, "a rejected request reached the upstream")
+
+        # HEAD, OPTIONS and chunked bodies
+        status, body = call("/graph/me", method="HEAD")
+        check(status == 200 and body == b"", "HEAD was not proxied without a body")
+        check(call("/graph/me", method="OPTIONS")[0] == 200, "OPTIONS was not proxied")
+        check(call("/graph/me", {"Transfer-Encoding": "chunked"}, "POST", iter([b"x"]))[0] == 411,
+              "chunked request body was not rejected")
+
+        # Connection reuse
+        start = len(upstream.requests)
+        for _ in range(5):
+            call("/graph/me")
+        ports = {r[3] for r in upstream.requests[start:]}
+        check(len(ports) == 1, f"upstream connection was not reused ({len(ports)} connections)")
+
+        # Stale pooled connection: GET is retried, POST is not
+        call("/graph/drop")
+        time.sleep(0.1)
+        check(call("/graph/me")[0] == 200, "GET on a stale pooled connection was not retried")
+        call("/graph/drop")
+        time.sleep(0.1)
+        start = len(upstream.requests)
+        check(call("/graph/me", method="POST", body=b"x")[0] == 502, "POST on a stale pooled connection was retried")
+        check(len(upstream.requests) == start, "POST was resent to the upstream")
+
+        # Concurrent 401s share one refresh; a persistent 401 doesn't force another login
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(call("/graph/reject")[0])) for _ in range(5)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        check(results == [200] * 5, "requests were not retried with the refreshed token")
+        check(auth.acquire_calls == 1, f"{auth.acquire_calls} refreshes for one rejected token")
+        check(call("/graph/always")[0] == 401, "persistent 401 was not passed through")
+        check(auth.acquire_calls == 1, "refresh cooldown was not applied")
+    finally:
+        httpd.shutdown()
+        httpd.server_close()
+        upstream.stop()
+    print("✅ Proxy checks passed.")
+
+    # Opaque tokens (no readable exp) are reused instead of looked up on every request
+    opaque_auth = FakeAuth(opaque=True)
+    tokens = TokenCache("Fake", opaque_auth)
+    check(tokens.get() == tokens.get() == "opaque-1", "opaque token was not cached")
+    check(opaque_auth.get_calls == 1, "opaque token was treated as expired")
+    print("✅ Token cache checks passed.")
+
+# ----------------------------
+# Main Execution Entry
+# ----------------------------
+
+def main():
+    if len(sys.argv) >= 2 and sys.argv[1] == "--fake":
+        run_fake_checks()
+        return
+
+    if len(sys.argv) < 3:
+        print("Usage: python auth_proxy.py <Port> <Prefix>=<RegistryPath> [<Prefix>=<RegistryPath> ...]")
+        print("       python auth_proxy.py --fake")
+        print(r"Example: python auth_proxy.py 8765 graph=Shukla\ShuklaApp")
+        sys.exit(1)
+
+    port = int(sys.argv[1])
+    routes = []
+    for mapping in sys.argv[2:]:
+        if "=" not in mapping:
+            print(f"❌ Invalid route '{mapping}', expected <Prefix>=<RegistryPath>")
+            sys.exit(1)
+        prefix, registry_path = mapping.split("=", 1)
+        routes.append(load_route(prefix, registry_path))
+
+    serve(routes, port)
+
+if __name__ == "__main__":
+    main()
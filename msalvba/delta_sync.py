@@ -0,0 +1,432 @@
+import sys
+import csv
+import json
+import sqlite3
+import threading
+import urllib.request
+import urllib.error
+from urllib.parse import urlparse, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from datetime import timezone, datetime
+
+# ----------------------------
+# Configuration
+# ----------------------------
+DEFAULT_DB_FILE = "delta_cache.db"
+REQUEST_TIMEOUT_SECONDS = 60
+FAKE_PAGE_SIZE = 2  # Small page size so the fake endpoint exercises @odata.nextLink paging
+
+# ----------------------------
+# Local Result Store (SQLite)
+# ----------------------------
+
+def open_store(db_file: str):
+    """Open (and create if needed) the local result store."""
+    conn = sqlite3.connect(db_file)
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS sync_state ("
+        " resource TEXT PRIMARY KEY,"
+        " delta_link TEXT,"
+        " etag TEXT,"
+        " last_sync TEXT)"
+    )
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS items ("
+        " resource TEXT NOT NULL,"
+        " id TEXT NOT NULL,"
+        " data TEXT NOT NULL,"
+        " PRIMARY KEY (resource, id))"
+    )
+    return conn
+
+def read_sync_state(conn, resource: str):
+    """Return (delta_link, etag) stored for a resource, or (None, None)."""
+    row = conn.execute(
+        "SELECT delta_link, etag FROM sync_state WHERE resource = ?", (resource,)
+    ).fetchone()
+    return row if row else (None, None)
+
+def store_sync_state(conn, resource: str, delta_link, etag):
+    """Persist the delta link / ETag for the next incremental run."""
+    timestamp = datetime.now(timezone.utc).isoformat()
+    conn.execute(
+        "INSERT INTO sync_state (resource, delta_link, etag, last_sync) VALUES (?, ?, ?, ?)"
+        " ON CONFLICT(resource) DO UPDATE SET"
+        " delta_link = excluded.delta_link, etag = excluded.etag, last_sync = excluded.last_sync",
+        (resource, delta_link, etag, timestamp),
+    )
+
+def apply_changes(conn, resource: str, changes):
+    """Apply a page of delta changes. Returns (upserted, removed) counts."""
+    upserted = removed = 0
+    for item in changes:
+        item_id = item.get("id")
+        if item_id is None:
+            continue
+        if "@removed" in item:
+            conn.execute("DELETE FROM items WHERE resource = ? AND id = ?", (resource, item_id))
+            removed += 1
+            continue
+
+        # Delta responses may carry only the changed properties, so merge into what we have.
+        row = conn.execute(
+            "SELECT data FROM items WHERE resource = ? AND id = ?", (resource, item_id)
+        ).fetchone()
+        data = json.loads(row[0]) if row else {}
+        data.update(item)
+        conn.execute(
+            "INSERT OR REPLACE INTO items (resource, id, data) VALUES (?, ?, ?)",
+            (resource, item_id, json.dumps(data)),
+        )
+        upserted += 1
+    return upserted, removed
+
+def load_items(conn, resource: str):
+    """Return all cached items for a resource."""
+    rows = conn.execute(
+        "SELECT data FROM items WHERE resource = ? ORDER BY id", (resource,)
+    ).fetchall()
+    return [json.loads(r[0]) for r in rows]
+
+# ----------------------------
+# HTTP
+# ----------------------------
+
+def http_get(url: str, token: str, etag=None):
+    """GET a URL with the bearer token. Returns (status, body, etag)."""
+    request = urllib.request.Request(url)
+    request.add_header("Authorization", f"Bearer {token}")
+    request.add_header("Accept", "application/json")
+    if etag:
+        request.add_header("If-None-Match", etag)
+    try:
+        with urllib.request.urlopen(request, timeout=REQUEST_TIMEOUT_SECONDS) as response:
+            body = json.loads(response.read().decode("utf-8"))
+            return response.status, body, response.headers.get("ETag")
+    except urllib.error.HTTPError as e:
+        if e.code == 304:
+            return 304, None, etag
+        if e.code == 410:
+            return 410, None, None
+        raise
+
+# ----------------------------
+# Sync Logic
+# ----------------------------
+
+def sync_resource(conn, resource_url: str, token: str):
+    """Sync one resource into the local store, fetching only changes when possible."""
+    force_full = False
+    while True:
+        delta_link, etag = read_sync_state(conn, resource_url)
+        if force_full:
+            delta_link = etag = None
+        url = delta_link or resource_url
+        mode = "incremental" if delta_link else "full"
+        print(f"🔄 Starting {mode} sync of {resource_url}")
+
+        upserted = removed = 0
+        first_page = True
+        new_etag = None
+        new_delta_link = None
+        expired = False
+        while url:
+            # ETags only make sense for the first page of a non-delta request.
+            send_etag = etag if first_page and not delta_link else None
+            status, body, page_etag = http_get(url, token, send_etag)
+
+            if status == 304:
+                print("✅ Not modified (ETag match). Using cached results.")
+                return 0, 0
+            if status == 410:
+                if not delta_link:
+                    conn.rollback()
+                    raise RuntimeError(f"Resource {resource_url} returned 410 Gone on a full sync.")
+                expired = True
+                break
+
+            if first_page:
+                new_etag = page_etag
+                first_page = False
+                if not delta_link:
+                    # A full pull returns the whole result set, so rows missing from it were deleted upstream.
+                    conn.execute("DELETE FROM items WHERE resource = ?", (resource_url,))
+
+            changes = body.get("value", [])
+            page_upserted, page_removed = apply_changes(conn, resource_url, changes)
+            upserted += page_upserted
+            removed += page_removed
+
+            if "@odata.nextLink" in body:
+                url = body["@odata.nextLink"]
+            else:
+                new_delta_link = body.get("@odata.deltaLink")
+                url = None
+
+        if expired:
+            # Keep the cache and stored link until the full pull below commits its replacement.
+            print("⚠️ Delta link expired. Falling back to a full sync...")
+            conn.rollback()
+            force_full = True
+            continue
+
+        # Commit items and the new delta link together so an interrupted run is simply retried.
+        store_sync_state(conn, resource_url, new_delta_link, new_etag)
+        conn.commit()
+        print(f"✅ Sync complete: {upserted} upserted, {removed} removed.")
+        return upserted, removed
+
+def export_items(items, output_file: str):
+    """Write cached rows to a CSV or JSON file that VBA can load into a sheet."""
+    if output_file.lower().endswith(".csv"):
+        columns = []
+        for item in items:
+            for key in item:
+                if key not in columns:
+                    columns.append(key)
+        # utf-8-sig writes a BOM so Excel doesn't read the file in the ANSI codepage.
+        with open(output_file, "w", newline="", encoding="utf-8-sig") as f:
+            writer = csv.DictWriter(f, fieldnames=columns)
+            writer.writeheader()
+            for item in items:
+                writer.writerow({k: json.dumps(v) if isinstance(v, (dict, list)) else v for k, v in item.items()})
+    else:
+        with open(output_file, "w", encoding="utf-8") as f:
+            json.dump(items, f, indent=2)
+    print(f"✅ {len(items)} rows written to {output_file}")
+
+# ----------------------------
+# Fake Delta Endpoint (offline testing)
+# ----------------------------
+
+class FakeDeltaServer:
+    """Local stand-in for a Graph delta endpoint, served from an in-memory change log.
+
+    With delta=False it behaves like a plain paged endpoint that never returns a deltaLink.
+    """
+
+    def __init__(self, items=None, page_size: int = FAKE_PAGE_SIZE, delta: bool = True):
+        self.page_size = page_size
+        self.delta = delta
+        self.version = 0
+        self.changes = []  # (version, change) tuples
+        self.expired_before = 0
+        self.fail_full_pulls = False  # Simulate an upstream error on full pulls
+        self.lock = threading.Lock()
+        for item in items or []:
+            self.upsert(item)
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), self._make_handler())
+        self.thread = None
+
+    @property
+    def url(self):
+        path = "/items/delta" if self.delta else "/items"
+        return f"http://127.0.0.1:{self.httpd.server_address[1]}{path}"
+
+    def upsert(self, item):
+        """Record an added or changed item."""
+        with self.lock:
+            self.version += 1
+            self.changes.append((self.version, dict(item)))
+
+    def remove(self, item_id):
+        """Record a deleted item."""
+        with self.lock:
+            self.version += 1
+            self.changes.append((self.version, {"id": item_id, "@removed": {"reason": "deleted"}}))
+
+    def expire_tokens(self):
+        """Make every previously issued delta link return 410 Gone."""
+        with self.lock:
+            self.expired_before = self.version
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def _changes_since(self, since: int):
+        """Collapse the change log after `since` into one entry per item.
+
+        A full pull (since == 0) returns whole merged objects and never reports deletions,
+        while a delta returns every property changed since then, merged per item.
+        """
+        latest = {}
+        for version, change in self.changes:
+            if version <= since:
+                continue
+            item_id = change["id"]
+            if "@removed" in change:
+                if since == 0:
+                    latest.pop(item_id, None)
+                else:
+                    latest[item_id] = dict(change)
+            elif "@removed" in latest.get(item_id, {}):
+                latest[item_id] = dict(change)  # Re-added after a delete
+            else:
+                latest.setdefault(item_id, {}).update(change)
+        return list(latest.values())
+
+    def _make_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                if not self.headers.get("Authorization", "").startswith("Bearer "):
+                    self._send(401, {"error": "missing bearer token"})
+                    return
+
+                query = parse_qs(urlparse(self.path).query)
+                since = int(query.get("token", ["0"])[0]) if server.delta else 0
+                skip = int(query.get("skip", ["0"])[0])
+                with server.lock:
+                    if since and since <= server.expired_before:
+                        self._send(410, {"error": "resyncRequired"})
+                        return
+                    if not since and server.fail_full_pulls:
+                        self._send(503, {"error": "serviceUnavailable"})
+                        return
+                    snapshot = server.version if skip == 0 else int(query["at"][0])
+                    changes = server._changes_since(since)
+
+                base = server.url
+                page = changes[skip:skip + server.page_size]
+                body = {"value": page}
+                if skip + server.page_size < len(changes):
+                    body["@odata.nextLink"] = f"{base}?token={since}&at={snapshot}&skip={skip + server.page_size}"
+                elif server.delta:
+                    body["@odata.deltaLink"] = f"{base}?token={snapshot}"
+                self._send(200, body)
+
+            def _send(self, status, body):
+                payload = json.dumps(body).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+        return Handler
+
+def check(condition: bool, message: str):
+    """Fail the offline checks with a readable message (unlike assert, not stripped by -O)."""
+    if not condition:
+        raise AssertionError(message)
+
+def cached(conn, resource: str):
+    """Cached rows keyed by id, for comparing against expected contents."""
+    return {item["id"]: item for item in load_items(conn, resource)}
+
+def run_fake_checks(db_file: str):
+    """Verify full, incremental, expired-link and paged non-delta syncs against the fake endpoint."""
+    rows = {str(i): {"id": str(i), "name": f"Row {i}", "value": i} for i in range(1, 6)}
+
+    server = FakeDeltaServer(items=rows.values()).start()
+    conn = open_store(db_file)
+    try:
+        # Full pull
+        sync_resource(conn, server.url, "fake-token")
+        check(cached(conn, server.url) == rows, "full pull did not cache every row")
+        delta_link, _ = read_sync_state(conn, server.url)
+        check(delta_link is not None, "full pull did not store a delta link")
+
+        # Incremental upsert, delete and insert
+        server.upsert({"id": "2", "value": 200})
+        server.remove("4")
+        server.upsert({"id": "6", "name": "Row 6", "value": 6})
+        check(sync_resource(conn, server.url, "fake-token") == (2, 1), "incremental sync fetched more than the changes")
+        rows["2"] = {"id": "2", "name": "Row 2", "value": 200}
+        del rows["4"]
+        rows["6"] = {"id": "6", "name": "Row 6", "value": 6}
+        check(cached(conn, server.url) == rows, "incremental sync did not apply changes")
+
+        # Two partial updates to one item in the same delta window both survive
+        server.upsert({"id": "1", "name": "Renamed"})
+        server.upsert({"id": "1", "value": 100})
+        sync_resource(conn, server.url, "fake-token")
+        rows["1"] = {"id": "1", "name": "Renamed", "value": 100}
+        check(cached(conn, server.url) == rows, "incremental sync lost one of two partial updates")
+
+        # A failed full pull after an expired delta link keeps the existing cache and link
+        server.expire_tokens()
+        server.fail_full_pulls = True
+        delta_link, _ = read_sync_state(conn, server.url)
+        try:
+            sync_resource(conn, server.url, "fake-token")
+            check(False, "full pull against a failing endpoint did not raise")
+        except urllib.error.HTTPError:
+            pass
+        check(cached(conn, server.url) == rows, "failed 410 resync emptied the cache")
+        check(read_sync_state(conn, server.url)[0] == delta_link, "failed 410 resync dropped the delta link")
+        server.fail_full_pulls = False
+
+        # Expired delta link falls back to a full resync with whole objects
+        sync_resource(conn, server.url, "fake-token")
+        check(cached(conn, server.url) == rows, "410 resync did not rebuild the cache")
+    finally:
+        conn.close()
+        server.stop()
+    print("✅ Delta endpoint checks passed.")
+
+    rows = {str(i): {"id": str(i), "name": f"Row {i}"} for i in range(1, 5)}
+    server = FakeDeltaServer(items=rows.values(), delta=False).start()
+    conn = open_store(db_file)
+    try:
+        # Paged plain endpoint: every run is a full pull and must drop rows deleted upstream
+        sync_resource(conn, server.url, "fake-token")
+        check(cached(conn, server.url) == rows, "paged full pull did not cache every row")
+        server.remove("2")
+        sync_resource(conn, server.url, "fake-token")
+        del rows["2"]
+        check(cached(conn, server.url) == rows, "paged full pull kept a row deleted upstream")
+    finally:
+        conn.close()
+        server.stop()
+    print("✅ Paged non-delta endpoint checks passed.")
+
+# ----------------------------
+# Main Execution Entry
+# ----------------------------
+
+def main():
+    if len(sys.argv) >= 2 and sys.argv[1] == "--fake":
+        db_file = sys.argv[2] if len(sys.argv) > 2 else ":memory:"
+        run_fake_checks(db_file)
+        return
+
+    if len(sys.argv) < 3:
+        print("Usage: python delta_sync.py <RegistryPath> <ResourceUrl> [DbFile] [OutputFile.csv|.json]")
+        print("       python delta_sync.py --fake [DbFile]")
+        sys.exit(1)
+
+    # Imported here so the offline fake mode also runs where winreg/msal are unavailable.
+    from auth_get_token_v4 import set_registry_path, get_token
+
+    reg_path_arg = sys.argv[1]
+    resource_url = sys.argv[2]
+    db_file = sys.argv[3] if len(sys.argv) > 3 else DEFAULT_DB_FILE
+    output_file = sys.argv[4] if len(sys.argv) > 4 else None
+
+    set_registry_path(reg_path_arg)
+    token = get_token()
+    if not token:
+        print("ERROR: Token acquisition failed")
+        sys.exit(1)
+
+    conn = open_store(db_file)
+    try:
+        sync_resource(conn, resource_url, token)
+        if output_file:
+            export_items(load_items(conn, resource_url), output_file)
+    finally:
+        conn.close()
+
+if __name__ == "__main__":
+    main()